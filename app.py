@@ -1,26 +1,33 @@
 from flask import Flask, request, jsonify, render_template
 import os
+import sys
 import requests
 from pathlib import Path
 import sqlite3
 import json
 import time
+import html
+import hashlib
+import uuid
+import re
+import heapq
+import itertools
+import threading
+from collections import Counter
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional, List, Dict, Any
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
 
-# PDF Processing imports
-try:
-    import PyPDF2
-    PYPDF2_AVAILABLE = True
-except ImportError:
-    PYPDF2_AVAILABLE = False
-
-try:
-    import pdfplumber
-    PDFPLUMBER_AVAILABLE = True
-except ImportError:
-    PDFPLUMBER_AVAILABLE = False
+from pdf_extraction import (
+    ANALYSIS_TEXT_LIMIT,
+    compute_document_stats,
+    document_stats,
+    read_pdf_prefix,
+    stage_pdf_pages,
+)
 
 try:
     import nltk
@@ -75,6 +82,7 @@ load_env_from_dotenv()
 # --- SQLite databases ---
 DB_PATH = 'cache.db'
 DOCUMENTS_DB_PATH = 'documents.db'
+FTS5_AVAILABLE = False
 CACHE_TTL_SECONDS = 3600  # 1 hour
 
 def init_cache_db():
@@ -93,6 +101,20 @@ def init_cache_db():
             """
         )
         cur.execute("CREATE INDEX IF NOT EXISTS idx_cache_topic_model ON mindmap_cache(topic, model)")
+        # Token-bucket levels shared by all worker processes (see GeminiScheduler)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rate_limit_state (
+                key_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                request_tokens REAL NOT NULL,
+                token_tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                blocked_until REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (key_id, model)
+            )
+            """
+        )
         conn.commit()
     finally:
         conn.close()
@@ -116,10 +138,117 @@ def init_documents_db():
             """
         )
         cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_user_id ON documents(user_id)")
+        # Per-document term statistics reused by multi-document mind maps
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS document_analysis (
+                document_id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                stats_json TEXT NOT NULL,
+                created_at INTEGER NOT NULL
+            )
+            """
+        )
         conn.commit()
     finally:
         conn.close()
 
+def init_search_db():
+    """
+    Create the search index: page text and mind map nodes live in document_pages
+    (indexed by document and user), and document_index is an FTS5 index over it
+    kept in sync by triggers.
+    """
+    global FTS5_AVAILABLE
+    try:
+        conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+        cur = conn.cursor()
+        # kind is 'page' (page text, page = 1-based number) or 'map' (node title + bullets)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS document_pages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document_id INTEGER NOT NULL,
+                user_id TEXT NOT NULL,
+                page INTEGER,
+                kind TEXT NOT NULL,
+                content TEXT NOT NULL
+            )
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_document_pages_doc ON document_pages(document_id, kind)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_document_pages_user ON document_pages(user_id)")
+        # Pages are staged here while a document is extracted, then swapped into
+        # document_pages in one transaction
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS document_pages_staging (
+                build_id TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                content TEXT NOT NULL
+            )
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_document_pages_staging_build ON document_pages_staging(build_id)")
+        # status is 'pending' (queued at upload), 'complete' or 'partial' (a cap or
+        # error stopped extraction early)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS document_index_status (
+                document_id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                pages_read INTEGER NOT NULL,
+                partial_reason TEXT,
+                updated_at INTEGER NOT NULL
+            )
+            """
+        )
+        # user_id is indexed in FTS too so a search only visits that user's rows
+        cur.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS document_index USING fts5(
+                content,
+                user_id,
+                content = 'document_pages',
+                content_rowid = 'id',
+                tokenize = 'porter unicode61'
+            )
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS document_pages_ai AFTER INSERT ON document_pages BEGIN
+                INSERT INTO document_index (rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+            END
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS document_pages_ad AFTER DELETE ON document_pages BEGIN
+                INSERT INTO document_index (document_index, rowid, content, user_id)
+                VALUES ('delete', old.id, old.content, old.user_id);
+            END
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS document_pages_au AFTER UPDATE ON document_pages BEGIN
+                INSERT INTO document_index (document_index, rowid, content, user_id)
+                VALUES ('delete', old.id, old.content, old.user_id);
+                INSERT INTO document_index (rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+            END
+            """
+        )
+        conn.commit()
+        FTS5_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5; search endpoint reports itself unavailable
+        print(f"FTS5 search index unavailable: {e}")
+        FTS5_AVAILABLE = False
+    finally:
+        conn.close()
+
 def get_cached_response(topic: str, model: str):
     now_ts = int(time.time())
     try:
@@ -157,6 +286,7 @@ def set_cached_response(topic: str, model: str, data: dict):
 # Initialize databases
 init_cache_db()
 init_documents_db()
+init_search_db()
 
 # Preferred models (in order). We'll try to pick the first one your API key can access.
 PREFERRED_MODEL_KEYS = [
@@ -192,20 +322,53 @@ def list_available_models(api_key: str) -> List[str]:
     except Exception:
         return []
 
-def choose_model(api_key: str) -> Optional[str]:
+# Model listings change rarely; cache each key's ranking instead of listing per request
+MODEL_RANKING_TTL_SECONDS = 600
+_model_rankings = {}  # api_key -> (expires_at, ranked models)
+_model_rankings_lock = threading.Lock()
+
+def rank_available_models(api_key: str) -> List[str]:
     """
-    Choose the best model available from PREFERRED_MODEL_KEYS.
-    Returns the short model name (e.g. 'gemini-2.5-flash') or None if none available.
+    Return the models available to the key, ordered by PREFERRED_MODEL_KEYS.
+    Used both to pick the best model and as the failover chain when its quota runs out.
     """
+    with _model_rankings_lock:
+        cached = _model_rankings.get(api_key)
+    if cached and cached[0] > time.time():
+        return list(cached[1])
     available = list_available_models(api_key)
     if not available:
-        return None
+        # Not cached, so a transient listing failure is retried on the next request
+        return []
+    ranked = []
     for prefer in PREFERRED_MODEL_KEYS:
         for a in available:
-            if a == prefer or a.startswith(prefer):
-                return a
+            if (a == prefer or a.startswith(prefer)) and a not in ranked:
+                ranked.append(a)
     # If none matched, return first available as last resort
-    return available[0] if available else None
+    ranked = ranked or [available[0]]
+    with _model_rankings_lock:
+        _model_rankings[api_key] = (time.time() + MODEL_RANKING_TTL_SECONDS, ranked)
+    return list(ranked)
+
+def model_preference_index(model: str) -> int:
+    """Position of a model in PREFERRED_MODEL_KEYS (unknown models sort last)."""
+    for index, prefer in enumerate(PREFERRED_MODEL_KEYS):
+        if model == prefer or model.startswith(prefer):
+            return index
+    return len(PREFERRED_MODEL_KEYS)
+
+def rank_models_for_keys(api_keys: List[str]) -> Dict[str, List[str]]:
+    """Map each API key to the models it can use, in preference order."""
+    return {k: rank_available_models(k) for k in api_keys}
+
+def merge_model_rankings(key_models: Dict[str, List[str]]) -> List[str]:
+    """Every model usable by at least one key, best first; the tail is the failover chain."""
+    models = []
+    for ranked in key_models.values():
+        models.extend(m for m in ranked if m not in models)
+    models.sort(key=model_preference_index)
+    return models
 
 def generate_content_url_for_model(model_short_name: str, api_key: str) -> str:
     """Construct the generateContent URL; include ?key= for API-key auth (and we also send header)."""
@@ -243,37 +406,179 @@ def build_fallback_response(topic: str) -> dict:
         }
     }
 
-# --- PDF Processing Functions ---
+# --- Model output parsing ---
 
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extract text from PDF file using available libraries."""
-    text = ""
-    
-    # Try pdfplumber first (better for complex PDFs)
-    if PDFPLUMBER_AVAILABLE:
-        try:
-            with pdfplumber.open(file_path) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-            if text.strip():
-                return text.strip()
-        except Exception as e:
-            print(f"pdfplumber extraction failed: {e}")
-    
-    # Fallback to PyPDF2
-    if PYPDF2_AVAILABLE:
-        try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-            return text.strip()
-        except Exception as e:
-            print(f"PyPDF2 extraction failed: {e}")
-    
-    raise Exception("Could not extract text from PDF. Please ensure pdfplumber or PyPDF2 is installed.")
+# Depth of the response schema sent to Gemini (schemas cannot be recursive).
+# Depth 4 covers root -> section -> subsection -> subsection children, as the prompt asks
+RESPONSE_SCHEMA_DEPTH = 4
+MAX_NODE_DEPTH = 6
+# Upper bound on '{' positions tried per response, so brace-heavy prose stays cheap
+MAX_JSON_CANDIDATES = 50
+_CLOSERS = {"{": "}", "[": "]"}
+FENCE_LINE_RE = re.compile(r"^[ \t]*```", re.MULTILINE)
+
+def build_node_schema(depth: int = RESPONSE_SCHEMA_DEPTH) -> dict:
+    properties = {
+        "title": {"type": "STRING"},
+        "learn_more": {"type": "STRING"},
+        "bulletPoints": {"type": "ARRAY", "items": {"type": "STRING"}},
+    }
+    if depth > 1:
+        properties["children"] = {"type": "ARRAY", "items": build_node_schema(depth - 1)}
+    return {"type": "OBJECT", "properties": properties, "required": ["title"]}
+
+MINDMAP_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"topic": {"type": "STRING"}, "root": build_node_schema()},
+    "required": ["topic", "root"],
+}
+
+def build_generation_config() -> dict:
+    """Ask the model for JSON that matches the mind map schema (structured output)."""
+    return {
+        "responseMimeType": "application/json",
+        "responseSchema": MINDMAP_RESPONSE_SCHEMA,
+    }
+
+def _scan_json_object(text: str, start: int):
+    """
+    Single pass over text[start:] (which begins with '{').
+    Returns (json_text, complete). Truncated input is cut back to the last point where
+    every value was complete and the still-open arrays/objects are closed.
+    """
+    stack = []
+    in_string = False
+    escaped = False
+    # (end index, open containers) where text[start:end] + closers is valid JSON
+    safe_end, safe_stack = None, None
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+            safe_end, safe_stack = i + 1, list(stack)
+        elif ch in "}]":
+            if not stack or _CLOSERS[stack[-1]] != ch:
+                break
+            stack.pop()
+            if not stack:
+                return text[start:i + 1], True
+            safe_end, safe_stack = i + 1, list(stack)
+        elif ch == ",":
+            safe_end, safe_stack = i, list(stack)
+    if safe_end is None:
+        return None, False
+    closers = "".join(_CLOSERS[c] for c in reversed(safe_stack))
+    return text[start:safe_end] + closers, False
+
+def extract_json_object(text: str, validate=None):
+    """
+    Pull a JSON object out of model output that may be wrapped in markdown fences or
+    prose, or be truncated. `validate` maps a parsed dict to the value to return, or
+    None to reject it and keep scanning. A complete candidate wins over a repaired
+    truncated one. Returns (value, complete) or (None, False).
+    """
+    if not text:
+        return None, False
+    validate = validate or (lambda parsed: parsed)
+    # Structured output is usually already plain JSON
+    try:
+        parsed = json.loads(text.strip())
+        value = validate(parsed) if isinstance(parsed, dict) else None
+        if value is not None:
+            return value, True
+    except ValueError:
+        pass
+    # Unwrap a ```json fence only when it opens a line before the JSON starts;
+    # backticks inside string values must not cut the text
+    first_brace = text.find("{")
+    fence = FENCE_LINE_RE.search(text, 0, first_brace if first_brace != -1 else len(text))
+    if fence:
+        body_start = text.find("\n", fence.start())
+        if body_start != -1:
+            body_end = text.find("\n```", body_start)
+            text = text[body_start + 1:body_end] if body_end != -1 else text[body_start + 1:]
+    repaired = None
+    start = text.find("{")
+    for _ in range(MAX_JSON_CANDIDATES):
+        if start == -1:
+            break
+        candidate, complete = _scan_json_object(text, start)
+        next_start = start + 1
+        if candidate:
+            try:
+                parsed = json.loads(candidate)
+            except ValueError:
+                parsed = None
+            value = validate(parsed) if isinstance(parsed, dict) else None
+            if value is not None and complete:
+                return value, True
+            if value is not None and repaired is None:
+                repaired = value
+            if parsed is not None and complete:
+                # A complete object that isn't what we want (e.g. an example in the
+                # prose); skip over it rather than rescanning its nested objects
+                next_start = start + len(candidate)
+        start = text.find("{", next_start)
+    return repaired, False
+
+def normalize_node(node: Any, depth: int = 0) -> Optional[Dict[str, Any]]:
+    """Coerce a node to {title, image, learn_more, bulletPoints, children}; None if unusable."""
+    if isinstance(node, str):
+        node = {"title": node}
+    if not isinstance(node, dict):
+        return None
+    title = node.get("title") or node.get("name")
+    if not isinstance(title, str) or not title.strip():
+        return None
+    bullets = node.get("bulletPoints")
+    if bullets is None:
+        bullets = node.get("bullet_points") or node.get("bullets") or []
+    if isinstance(bullets, str):
+        bullets = [bullets]
+    children = node.get("children") if depth < MAX_NODE_DEPTH else []
+    if not isinstance(children, list):
+        children = []
+    learn_more = node.get("learn_more")
+    image = node.get("image")
+    return {
+        "title": title.strip(),
+        "image": image if isinstance(image, str) else "",
+        "learn_more": learn_more if isinstance(learn_more, str) else "",
+        "bulletPoints": [str(b).strip() for b in bullets if isinstance(b, (str, int, float)) and str(b).strip()]
+        if isinstance(bullets, list) else [],
+        "children": [c for c in (normalize_node(child, depth + 1) for child in children) if c],
+    }
+
+def normalize_mindmap(data: Any, topic: str) -> Optional[Dict[str, Any]]:
+    """Validate model output against the mind map shape; returns None if there is no usable root."""
+    if not isinstance(data, dict):
+        return None
+    root = data.get("root")
+    if root is None and ("title" in data or "children" in data):
+        # Model returned the root node without the wrapper
+        root = data
+    if isinstance(root, dict) and not root.get("title"):
+        root = dict(root, title=data.get("topic") or topic)
+    root = normalize_node(root)
+    if not root or not root["children"]:
+        return None
+    map_topic = data.get("topic")
+    return {
+        "topic": map_topic.strip() if isinstance(map_topic, str) and map_topic.strip() else root["title"],
+        "root": root,
+    }
+
+# --- PDF Processing Functions ---
 
 def analyze_topics_hierarchy(text: str) -> Dict[str, Any]:
     """
@@ -286,7 +591,7 @@ def analyze_topics_hierarchy(text: str) -> Dict[str, Any]:
     
     try:
         # Extract sentences
-        sentences = sent_tokenize(text[:10000])  # Limit to first 10k chars for performance
+        sentences = sent_tokenize(text[:ANALYSIS_TEXT_LIMIT])  # Limit to first 10k chars for performance
         
         # Find headings and topics (typically capitalized or short sentences)
         headings = []
@@ -398,6 +703,453 @@ def create_basic_mindmap(text: str) -> Dict[str, Any]:
         }
     }
 
+# --- Full-text search index ---
+
+SEARCH_DEFAULT_PER_PAGE = 10
+SEARCH_MAX_PER_PAGE = 50
+INDEX_BATCH_PAGES = 25
+INDEX_WORKERS = 2
+# A 'pending' index older than this is assumed lost (e.g. worker restart) and rebuilt on demand
+INDEX_PENDING_TIMEOUT_SECONDS = 15 * 60
+# Highlight markers used inside snippet(); swapped for <mark> after HTML-escaping
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+# PDF extraction processes (see get_extraction_pool)
+EXTRACTION_WORKERS = min(4, os.cpu_count() or 1)
+EXTRACTION_TASKS_PER_WORKER = 50
+
+# Background workers that index uploads off the request thread; they wait on the
+# extraction pool and do the SQLite swap
+indexing_executor = ThreadPoolExecutor(max_workers=INDEX_WORKERS)
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def get_extraction_pool() -> ProcessPoolExecutor:
+    """
+    Shared process pool for PDF extraction, created on first use. forkserver/spawn
+    workers don't inherit this process's threads or held locks, and each worker runs
+    one job at a time so the per-job memory cap only measures that job.
+    """
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            options = {}
+            if sys.version_info >= (3, 11):
+                # Recycle workers now and then; RSS rarely shrinks after a large PDF
+                options["max_tasks_per_child"] = EXTRACTION_TASKS_PER_WORKER
+            _extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=context, **options)
+        return _extraction_pool
+
+def submit_extraction_job(job, *args) -> Future:
+    """Queue a pdf_extraction job on the shared pool."""
+    pool = get_extraction_pool()
+    try:
+        return pool.submit(job, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory) and took the pool with it; start a fresh one
+        global _extraction_pool
+        with _extraction_pool_lock:
+            if _extraction_pool is pool:
+                _extraction_pool = None
+        return get_extraction_pool().submit(job, *args)
+
+def run_extraction_job(job, *args):
+    """Run a pdf_extraction job in the pool and wait for its result."""
+    return submit_extraction_job(job, *args).result()
+
+def index_document_pages(doc_id: int, user_id: str, file_path: str) -> Dict[str, Any]:
+    """
+    Replace the indexed page text for a document. Pages are extracted and staged by a
+    pool worker, then swapped in with the document's complete/partial status in one
+    transaction. Returns the worker's result (analysis text prefix, truncated, pages_read).
+    """
+    build_id = uuid.uuid4().hex
+    db_path = os.path.abspath(DOCUMENTS_DB_PATH)
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH, timeout=30)
+    try:
+        result = run_extraction_job(stage_pdf_pages, file_path, db_path, build_id, INDEX_BATCH_PAGES)
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        # Skip the swap if the document was deleted while it was being extracted
+        cur.execute("SELECT 1 FROM documents WHERE id = ?", (doc_id,))
+        if cur.fetchone():
+            cur.execute("DELETE FROM document_pages WHERE document_id = ? AND kind = 'page'", (doc_id,))
+            cur.execute(
+                """
+                INSERT INTO document_pages (document_id, user_id, page, kind, content)
+                SELECT ?, ?, page, 'page', content FROM document_pages_staging WHERE build_id = ? ORDER BY page
+                """,
+                (doc_id, user_id, build_id),
+            )
+            cur.execute(
+                """
+                INSERT OR REPLACE INTO document_index_status
+                    (document_id, user_id, status, pages_read, partial_reason, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (doc_id, user_id, "partial" if result["truncated"] else "complete",
+                 result["pages_read"], result["truncated"], int(time.time())),
+            )
+        cur.execute("DELETE FROM document_pages_staging WHERE build_id = ?", (build_id,))
+        conn.commit()
+        return result
+    finally:
+        # Discard anything left staged by a failed build
+        try:
+            conn.rollback()
+            conn.execute("DELETE FROM document_pages_staging WHERE build_id = ?", (build_id,))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+        conn.close()
+
+def _flatten_mindmap_nodes(node: Dict[str, Any]):
+    """Yield 'title + bullets' text for every node in a mind map tree."""
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if not isinstance(current, dict):
+            continue
+        lines = [current.get("title") or ""] + list(current.get("bulletPoints") or [])
+        text = "\n".join(str(line) for line in lines if line)
+        if text:
+            yield text
+        stack.extend(current.get("children") or [])
+
+def index_document_mindmap(doc_id: int, user_id: str, mindmap: Dict[str, Any]) -> None:
+    """Replace the indexed mind map nodes for a document."""
+    if not FTS5_AVAILABLE:
+        return
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH, timeout=30)
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT 1 FROM documents WHERE id = ?", (doc_id,))
+        if cur.fetchone():
+            cur.execute("DELETE FROM document_pages WHERE document_id = ? AND kind = 'map'", (doc_id,))
+            cur.executemany(
+                "INSERT INTO document_pages (content, document_id, user_id, page, kind) VALUES (?, ?, ?, NULL, 'map')",
+                [(text, doc_id, user_id) for text in _flatten_mindmap_nodes(mindmap.get("root") or {})],
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+def is_document_indexed(doc_id: int) -> bool:
+    """True only when every page of the document has been indexed (not a partial index)."""
+    if not FTS5_AVAILABLE:
+        return False
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT status FROM document_index_status WHERE document_id = ?", (doc_id,))
+        row = cur.fetchone()
+        return bool(row) and row[0] == "complete"
+    finally:
+        conn.close()
+
+def is_document_index_pending(doc_id: int) -> bool:
+    """True while an upload's background index build is queued or running (and not stale)."""
+    if not FTS5_AVAILABLE:
+        return False
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT status, updated_at FROM document_index_status WHERE document_id = ?", (doc_id,))
+        row = cur.fetchone()
+        return bool(row) and row[0] == "pending" and time.time() - row[1] < INDEX_PENDING_TIMEOUT_SECONDS
+    finally:
+        conn.close()
+
+def set_document_index_pending(doc_id: int, user_id: str, pending: bool = True) -> None:
+    """Mark a queued index build, or clear the mark when the build failed."""
+    if not FTS5_AVAILABLE:
+        return
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH, timeout=30)
+    try:
+        if pending:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO document_index_status
+                    (document_id, user_id, status, pages_read, partial_reason, updated_at)
+                VALUES (?, ?, 'pending', 0, NULL, ?)
+                """,
+                (doc_id, user_id, int(time.time())),
+            )
+        else:
+            conn.execute("DELETE FROM document_index_status WHERE document_id = ? AND status = 'pending'", (doc_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def remove_document_from_index(doc_id: int) -> None:
+    if not FTS5_AVAILABLE:
+        return
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+    try:
+        conn.execute("DELETE FROM document_pages WHERE document_id = ?", (doc_id,))
+        conn.execute("DELETE FROM document_index_status WHERE document_id = ?", (doc_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def extract_analysis_text(doc_id: int, user_id: str, file_path: str, index_pages: bool) -> Dict[str, Any]:
+    """
+    Extract a PDF once in the pool, indexing every page when asked, and return
+    {text, truncated, pages_read} where text is the prefix used for topic analysis.
+    Without indexing only the first pages are parsed.
+    """
+    if not (index_pages and FTS5_AVAILABLE):
+        return run_extraction_job(read_pdf_prefix, file_path)
+    return index_document_pages(doc_id, user_id, file_path)
+
+def index_uploaded_document(doc_id: int, user_id: str, file_path: str) -> None:
+    """Index page text and the generated mind map so search never re-parses the PDF."""
+    if not FTS5_AVAILABLE:
+        return
+    try:
+        result = extract_analysis_text(doc_id, user_id, file_path, index_pages=True)
+        if result["truncated"]:
+            print(f"Indexing of document {doc_id} stopped after {result['pages_read']} pages: {result['truncated']}")
+        if len(result["text"]) >= 100:
+            index_document_mindmap(doc_id, user_id, analyze_topics_hierarchy(result["text"]))
+    except Exception as e:
+        # Indexing is best effort; the upload itself already succeeded. Clear the
+        # pending mark so /api/pdf-mindmap backfills the index instead
+        print(f"Failed to index document {doc_id}: {e}")
+        try:
+            set_document_index_pending(doc_id, user_id, pending=False)
+        except sqlite3.Error:
+            pass
+
+def highlight_snippet(snippet: Optional[str]) -> str:
+    """HTML-escape PDF text first, then turn the match markers into <mark> tags."""
+    escaped = html.escape(snippet or "")
+    return escaped.replace(SNIPPET_START, "<mark>").replace(SNIPPET_END, "</mark>")
+
+def fts_phrase(value: str) -> str:
+    """Quote a value as a single FTS5 phrase."""
+    return '"' + value.replace('"', '""') + '"'
+
+def build_fts_query(query: str) -> str:
+    """Quote each term so user input can't break FTS5 query syntax; terms are ANDed."""
+    return " ".join(fts_phrase(t) for t in query.split() if t.strip('"'))
+
+def search_documents(user_id: str, query: str, page: int = 1, per_page: int = SEARCH_DEFAULT_PER_PAGE) -> Dict[str, Any]:
+    """Ranked (bm25), highlighted and paginated search over one user's indexed documents."""
+    fts_query = build_fts_query(query)
+    if not fts_query:
+        return {"query": query, "page": page, "per_page": per_page, "total": 0, "results": []}
+    # Restrict the match to the user's rows inside FTS; the exact user_id check on
+    # document_pages guards against ids that tokenize the same
+    if re.search(r"\w", user_id):
+        match = f"user_id : {fts_phrase(user_id)} AND content : ({fts_query})"
+    else:
+        match = f"content : ({fts_query})"
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT COUNT(*)
+            FROM document_index
+            JOIN document_pages p ON p.id = document_index.rowid
+            WHERE document_index MATCH ? AND p.user_id = ?
+            """,
+            (match, user_id),
+        )
+        total = cur.fetchone()[0]
+        cur.execute(
+            """
+            SELECT p.document_id, d.filename, p.page, p.kind,
+                   snippet(document_index, 0, ?, ?, '...', 24) AS snippet,
+                   bm25(document_index, 1.0, 0.0) AS score
+            FROM document_index
+            JOIN document_pages p ON p.id = document_index.rowid
+            JOIN documents d ON d.id = p.document_id
+            WHERE document_index MATCH ? AND p.user_id = ?
+            ORDER BY score
+            LIMIT ? OFFSET ?
+            """,
+            (SNIPPET_START, SNIPPET_END, match, user_id, per_page, (page - 1) * per_page),
+        )
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    results = []
+    for row in rows:
+        results.append({
+            "document_id": row[0],
+            "filename": row[1],
+            "page": row[2],
+            "kind": row[3],
+            "snippet": highlight_snippet(row[4]),
+            "score": row[5]
+        })
+    return {"query": query, "page": page, "per_page": per_page, "total": total, "results": results}
+
+# --- Multi-document mind maps ---
+
+MULTI_DOC_MAX_DOCUMENTS = 20
+MULTI_DOC_THEMES = 8
+
+BASIC_STOP_WORDS = set(
+    "the and for are but not you all any can had her was one our out has have this that with from they "
+    "will would there their what about which when make like than then them these some into also more "
+    "other such only its may each where been were who how used using use between both through".split()
+)
+
+def get_stop_words() -> set:
+    if NLTK_AVAILABLE:
+        try:
+            return set(stopwords.words('english'))
+        except Exception:
+            pass
+    return BASIC_STOP_WORDS
+
+def iter_indexed_pages(doc_id: int):
+    """Yield (page, text) from the search index, so indexed documents are never re-parsed."""
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT page, content FROM document_pages WHERE document_id = ? AND kind = 'page' ORDER BY page",
+            (doc_id,),
+        )
+        for row in cur:
+            yield row[0], row[1]
+    finally:
+        conn.close()
+
+def get_cached_document_stats(doc_id: int) -> Optional[Dict[str, Any]]:
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT stats_json FROM document_analysis WHERE document_id = ?", (doc_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        try:
+            return json.loads(row[0])
+        except Exception:
+            return None
+    finally:
+        conn.close()
+
+def set_cached_document_stats(doc_id: int, user_id: str, stats: Dict[str, Any]) -> None:
+    conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO document_analysis (document_id, user_id, stats_json, created_at) VALUES (?, ?, ?, ?)",
+            (doc_id, user_id, json.dumps(stats), int(time.time())),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def load_stored_document_stats(doc_id: int, user_id: str, stop_words: set) -> Optional[tuple]:
+    """
+    Return (stats, reused) without touching the PDF: stored statistics, or statistics
+    built from a complete page index. None when the document still needs extraction.
+    """
+    cached = get_cached_document_stats(doc_id)
+    if cached:
+        return cached, True
+    # A partial index would give partial statistics, so only a complete one is used
+    if is_document_indexed(doc_id):
+        stats = compute_document_stats(iter_indexed_pages(doc_id), stop_words)
+        stats["partial_reason"] = None
+        set_cached_document_stats(doc_id, user_id, stats)
+        return stats, False
+    return None
+
+def _sentences_with_term(stats: Dict[str, Any], term: str, limit: int) -> List[list]:
+    pattern = re.compile(r"\b" + re.escape(term) + r"\b", re.IGNORECASE)
+    found = []
+    for sentence, page in stats.get("sentences") or []:
+        if pattern.search(sentence):
+            found.append([sentence, page])
+            if len(found) >= limit:
+                break
+    return found
+
+def build_multi_document_mindmap(documents: List[Dict[str, Any]], topic: str) -> Dict[str, Any]:
+    """
+    Merge per-document statistics into one mind map. `documents` holds dicts with
+    id, filename and stats. Themes are ranked by summed relative frequency, so terms
+    shared across documents win over terms that are frequent in one large document.
+    """
+    scores = Counter()
+    for doc in documents:
+        total = doc["stats"].get("total_terms") or 1
+        for term, count in doc["stats"]["terms"].items():
+            scores[term] += count / total
+
+    children = []
+    for term, _ in scores.most_common(MULTI_DOC_THEMES):
+        sources = []
+        source_nodes = []
+        bullets = []
+        for doc in documents:
+            stats = doc["stats"]
+            if term not in stats["terms"]:
+                continue
+            pages = stats["term_pages"].get(term, [])
+            source = {"document_id": doc["id"], "filename": doc["filename"], "pages": pages}
+            sources.append(source)
+            mentions = _sentences_with_term(stats, term, 3)
+            bullets.extend(sentence[:150] for sentence, _ in mentions[:2])
+            source_nodes.append({
+                "title": doc["filename"],
+                "image": "",
+                "learn_more": "",
+                "children": [],
+                "bulletPoints": [f"{sentence[:150]} (p. {page})" for sentence, page in mentions],
+                "source": source
+            })
+        children.append({
+            "title": term.title(),
+            "image": "",
+            "learn_more": "",
+            "children": source_nodes,
+            "bulletPoints": bullets[:5],
+            "sources": sources
+        })
+
+    document_nodes = []
+    for doc in documents:
+        top_terms = list(doc["stats"]["terms"])[:6]
+        document_nodes.append({
+            "title": doc["filename"],
+            "image": "",
+            "learn_more": "",
+            "children": [],
+            "bulletPoints": [f"Key terms: {', '.join(top_terms)}"] if top_terms else [],
+            "source": {"document_id": doc["id"], "filename": doc["filename"], "pages": []}
+        })
+    children.append({
+        "title": "Documents",
+        "image": "",
+        "learn_more": "",
+        "children": document_nodes,
+        "bulletPoints": []
+    })
+
+    return {
+        "topic": topic,
+        "root": {
+            "title": topic,
+            "image": "",
+            "learn_more": "",
+            "children": children,
+            "bulletPoints": []
+        }
+    }
+
 @app.route("/")
 def landing_page():
     """Login page route"""
@@ -429,15 +1181,19 @@ def api_mindmap():
     if not topic:
         return jsonify({"error": "Missing 'topic' query parameter"}), 400
 
-    api_key = os.getenv("GEMINI_API_KEY", "").strip()
-    if not api_key:
+    api_keys = get_api_keys()
+    if not api_keys:
         return jsonify({"error": "GEMINI_API_KEY environment variable not set on server"}), 500
 
     # Allow memory-cache bypass
     no_cache = request.args.get("nocache", "0").strip() == "1"
+    # Prewarm/batch callers pass priority=batch so interactive requests are served first
+    priority = PRIORITY_BATCH if request.args.get("priority", "").strip() == "batch" else PRIORITY_INTERACTIVE
 
-    # Determine model dynamically (and cache choice in request-lifetime)
-    chosen_model = choose_model(api_key)
+    # Determine model dynamically per key; the rest of the ranking is the failover chain
+    key_models = rank_models_for_keys(api_keys)
+    ranked_models = merge_model_rankings(key_models)
+    chosen_model = ranked_models[0] if ranked_models else None
     if not chosen_model:
         return jsonify({
             "error": "Unable to list available models with provided API key. "
@@ -445,9 +1201,8 @@ def api_mindmap():
             "hint": "Try creating an API key at https://aistudio.google.com/app/apikey and set GEMINI_API_KEY."
         }), 502
 
-    model_for_cache = chosen_model
     if not no_cache:
-        cached = get_cached_response(topic, model_for_cache)
+        cached = get_cached_response(topic, chosen_model)
         if cached and isinstance(cached, dict) and cached.get("topic") and cached.get("root"):
             return jsonify(cached)
 
@@ -473,46 +1228,54 @@ def api_mindmap():
                     f"{system_prompt}\nUser topic: {topic}"
                 )
             }]
-        }]
+        }],
+        "generationConfig": build_generation_config(),
     }
 
     try:
-        url = generate_content_url_for_model(chosen_model, api_key)
-        data = post_and_parse(url, simple_payload, api_key)
+        model_for_cache, data = scheduled_generate(key_models, simple_payload, priority)
 
         # If the service returned direct JSON
         if isinstance(data, dict) and "topic" in data and "root" in data:
-            try:
-                set_cached_response(topic, model_for_cache, data)
-            except Exception:
-                pass
-            return jsonify(data)
+            normalized = normalize_mindmap(data, topic)
+            if normalized:
+                try:
+                    set_cached_response(topic, model_for_cache, normalized)
+                except Exception:
+                    pass
+                return jsonify(normalized)
 
         # Otherwise inspect 'candidates' -> content -> parts -> text (common Gemini shape)
         candidates = data.get("candidates", []) if isinstance(data, dict) else []
         for c in candidates:
             parts = (((c or {}).get("content") or {}).get("parts")) or []
-            for p in parts:
-                text = p.get("text")
-                if not text:
-                    continue
+            # Long answers may be split across several text parts
+            text = "".join(p.get("text") or "" for p in parts if isinstance(p, dict))
+            normalized, complete = extract_json_object(text, lambda parsed: normalize_mindmap(parsed, topic))
+            if not normalized:
+                continue
+            # Don't cache a repaired truncated answer; a later call may get the full map
+            if complete:
                 try:
-                    parsed = json.loads(text)
-                    if isinstance(parsed, dict) and "topic" in parsed and "root" in parsed:
-                        try:
-                            set_cached_response(topic, model_for_cache, parsed)
-                        except Exception:
-                            pass
-                        return jsonify(parsed)
+                    set_cached_response(topic, model_for_cache, normalized)
                 except Exception:
-                    continue
+                    pass
+            return jsonify(normalized)
 
-        # If we reach here, format wasn't found
+        # If we reach here, format wasn't found; don't cache the placeholder so the
+        # next request retries upstream instead of serving it for an hour
+        fallback = build_fallback_response(topic)
+        return jsonify(fallback), 200
+
+    except QuotaExhausted:
+        # Out of budget everywhere: a cached answer from a failover model beats the placeholder
+        if not no_cache:
+            for cache_model in ranked_models[1:]:
+                cached = get_cached_response(topic, cache_model)
+                if cached and isinstance(cached, dict) and cached.get("topic") and cached.get("root"):
+                    return jsonify(cached)
+        # Serve fallback without caching it so the next request retries upstream
         fallback = build_fallback_response(topic)
-        try:
-            set_cached_response(topic, model_for_cache, fallback)
-        except Exception:
-            pass
         return jsonify(fallback), 200
 
     except requests.HTTPError as e:
@@ -592,6 +1355,14 @@ def upload_pdf():
                 os.remove(file_path)
             return jsonify({"error": "Failed to save document metadata"}), 500
         
+        # Extraction and analysis run in the background so the upload returns immediately;
+        # the pending mark stops /api/pdf-mindmap from building the same index meanwhile
+        try:
+            set_document_index_pending(doc_id, user_id)
+        except sqlite3.Error as e:
+            print(f"Failed to mark document {doc_id} for indexing: {e}")
+        indexing_executor.submit(index_uploaded_document, doc_id, user_id, file_path)
+        
         return jsonify({
             "success": True,
             "message": "File uploaded successfully",
@@ -664,9 +1435,12 @@ def delete_document(doc_id):
         
         # Delete from database
         cur.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+        cur.execute("DELETE FROM document_analysis WHERE document_id = ?", (doc_id,))
         conn.commit()
         conn.close()
         
+        remove_document_from_index(doc_id)
+        
         # Delete file from disk
         if os.path.exists(file_path):
             try:
@@ -703,8 +1477,17 @@ def generate_pdf_mindmap(doc_id):
         if not os.path.exists(file_path):
             return jsonify({"error": "PDF file not found on server"}), 404
         
-        # Extract text from PDF
-        text = extract_text_from_pdf(file_path)
+        # Stream text from PDF page by page; pages are indexed on the way through
+        # (backfilling documents uploaded before indexing existed), otherwise
+        # extraction stops once there is enough text for analysis. A build already
+        # queued by the upload isn't repeated here.
+        index_pages = not is_document_indexed(doc_id) and not is_document_index_pending(doc_id)
+        try:
+            result = extract_analysis_text(doc_id, user_id, file_path, index_pages=index_pages)
+        except sqlite3.Error as e:
+            print(f"Failed to index document {doc_id}: {e}")
+            result = run_extraction_job(read_pdf_prefix, file_path)
+        text = result["text"]
         
         if not text or len(text) < 100:
             return jsonify({"error": "Could not extract meaningful text from PDF"}), 400
@@ -712,12 +1495,141 @@ def generate_pdf_mindmap(doc_id):
         # Analyze topics and create mindmap
         mindmap = analyze_topics_hierarchy(text)
         
+        try:
+            index_document_mindmap(doc_id, user_id, mindmap)
+        except Exception as e:
+            print(f"Failed to index document {doc_id}: {e}")
+        
+        # A page/time/memory cap stopped extraction; the map covers the pages read so far
+        if result["truncated"]:
+            mindmap["partial"] = True
+            mindmap["partial_reason"] = result["truncated"]
+            mindmap["pages_read"] = result["pages_read"]
+        
         return jsonify(mindmap), 200
         
     except Exception as e:
         print(f"Error generating PDF mindmap: {e}")
         return jsonify({"error": f"Failed to generate mindmap: {str(e)}"}), 500
 
+@app.route("/api/multi-pdf-mindmap", methods=["POST"])
+def generate_multi_pdf_mindmap():
+    """Generate one combined mindmap from several of a user's PDF documents."""
+    try:
+        payload = request.get_json(silent=True) or {}
+        user_id = payload.get('user_id')
+        raw_ids = payload.get('document_ids', [])
+        
+        # A JSON null or number must not be stringified into someone's user id
+        if user_id is not None and not isinstance(user_id, str):
+            return jsonify({"error": "'user_id' must be a string"}), 400
+        user_id = (user_id or '').strip()
+        if not user_id:
+            return jsonify({"error": "User ID required"}), 400
+        
+        # bool is an int subclass, and strings/dicts are iterable; accept only a real list of ints
+        if not isinstance(raw_ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in raw_ids):
+            return jsonify({"error": "'document_ids' must be a list of integers"}), 400
+        doc_ids = list(dict.fromkeys(raw_ids))
+        
+        if not doc_ids:
+            return jsonify({"error": "Missing 'document_ids'"}), 400
+        
+        if len(doc_ids) > MULTI_DOC_MAX_DOCUMENTS:
+            return jsonify({"error": f"At most {MULTI_DOC_MAX_DOCUMENTS} documents per mindmap"}), 400
+        
+        # Only documents owned by this user are considered
+        conn = sqlite3.connect(DOCUMENTS_DB_PATH)
+        cur = conn.cursor()
+        placeholders = ",".join("?" for _ in doc_ids)
+        cur.execute(
+            f"SELECT id, filename, file_path FROM documents WHERE user_id = ? AND id IN ({placeholders})",
+            [user_id] + doc_ids
+        )
+        rows = {row[0]: row for row in cur.fetchall()}
+        conn.close()
+        
+        missing = [i for i in doc_ids if i not in rows]
+        if missing:
+            return jsonify({"error": "Document not found", "document_ids": missing}), 404
+        
+        stop_words = get_stop_words()
+        results = {}
+        pending = {}
+        for doc_id in doc_ids:
+            stored = load_stored_document_stats(doc_id, user_id, stop_words)
+            if stored:
+                results[doc_id] = stored
+            elif not os.path.exists(rows[doc_id][2]):
+                return jsonify({"error": f"PDF file for document {doc_id} not found on server"}), 404
+            else:
+                pending[doc_id] = rows[doc_id][2]
+        
+        # Extract the remaining documents in parallel on the extraction pool (pdf parsing is CPU bound)
+        futures = {
+            doc_id: submit_extraction_job(document_stats, file_path, stop_words)
+            for doc_id, file_path in pending.items()
+        }
+        for doc_id, future in futures.items():
+            stats = future.result()
+            # Capped extractions aren't stored so a later request can try the full document again
+            if not stats["partial_reason"]:
+                set_cached_document_stats(doc_id, user_id, stats)
+            results[doc_id] = (stats, False)
+        
+        documents = [
+            {"id": doc_id, "filename": rows[doc_id][1], "stats": results[doc_id][0], "reused": results[doc_id][1]}
+            for doc_id in doc_ids
+        ]
+        
+        if not any(doc["stats"]["terms"] for doc in documents):
+            return jsonify({"error": "Could not extract meaningful text from the documents"}), 400
+        
+        topic = str(payload.get('title') or '').strip()[:100] or f"{len(documents)} documents"
+        mindmap = build_multi_document_mindmap(documents, topic)
+        mindmap["documents"] = [
+            {
+                "id": doc["id"],
+                "filename": doc["filename"],
+                "reused": doc["reused"],
+                "partial_reason": doc["stats"].get("partial_reason")
+            }
+            for doc in documents
+        ]
+        
+        return jsonify(mindmap), 200
+        
+    except Exception as e:
+        print(f"Error generating multi-document mindmap: {e}")
+        return jsonify({"error": f"Failed to generate mindmap: {str(e)}"}), 500
+
+@app.route("/api/search", methods=["GET"])
+def search_user_documents():
+    """Full-text search across a user's documents and their generated mind maps."""
+    try:
+        user_id = request.args.get('user_id', '').strip()
+        query = request.args.get('q', '').strip()
+        
+        if not user_id:
+            return jsonify({"error": "User ID required"}), 400
+        
+        if not query:
+            return jsonify({"error": "Missing 'q' query parameter"}), 400
+        
+        if not FTS5_AVAILABLE:
+            return jsonify({"error": "Search is not available on this server"}), 503
+        
+        try:
+            page = max(1, int(request.args.get('page', 1)))
+            per_page = min(SEARCH_MAX_PER_PAGE, max(1, int(request.args.get('per_page', SEARCH_DEFAULT_PER_PAGE))))
+        except ValueError:
+            return jsonify({"error": "'page' and 'per_page' must be integers"}), 400
+        
+        return jsonify(search_documents(user_id, query, page, per_page)), 200
+        
+    except Exception as e:
+        return jsonify({"error": f"Search failed: {str(e)}"}), 500
+
 @app.errorhandler(404)
 def handle_404(e):
     if request.path.startswith('/api/'):
@@ -753,5 +1665,251 @@ def post_and_parse(url_to_use: str, payload_to_use: dict, api_key: str):
     # If we exhausted retries on network errors
     raise requests.RequestException(f"Network error after retries: {last_exc}")
 
+# --- Gemini rate limiting / quota scheduling ---
+
+# Per-key budgets as (requests/min, tokens/min), matched by model prefix like
+# PREFERRED_MODEL_KEYS. Adjust to the quota tier of your API keys.
+MODEL_RATE_LIMITS = {
+    "gemini-2.5-pro": (5, 250000),
+    "gemini-1.5-pro": (2, 32000),
+    "gemini-2.5-flash": (10, 250000),
+    "gemini-1.5-flash": (15, 1000000),
+}
+DEFAULT_MODEL_RATE_LIMIT = (5, 100000)
+
+# Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+# How long a queued request may wait for budget before giving up
+SCHEDULER_MAX_WAIT_SECONDS = {PRIORITY_INTERACTIVE: 20, PRIORITY_BATCH: 120}
+# Output budget assumed when reserving tokens; reconciled with usageMetadata afterwards
+ESTIMATED_OUTPUT_TOKENS = 4096
+# Cool-down applied to a key/model pair after a 429 without a Retry-After header
+RATE_LIMITED_COOLDOWN_SECONDS = 30
+
+class QuotaExhausted(Exception):
+    """Raised when no key/model pair has budget within the allowed wait."""
+
+def get_api_keys() -> List[str]:
+    """Return configured Gemini keys: GEMINI_API_KEYS (comma separated) or GEMINI_API_KEY."""
+    raw = os.getenv("GEMINI_API_KEYS", "").strip() or os.getenv("GEMINI_API_KEY", "").strip()
+    return [k.strip() for k in raw.split(",") if k.strip()]
+
+def get_model_rate_limit(model: str):
+    for prefix, limit in MODEL_RATE_LIMITS.items():
+        if model == prefix or model.startswith(prefix):
+            return limit
+    return DEFAULT_MODEL_RATE_LIMIT
+
+def estimate_request_tokens(payload: dict) -> int:
+    """Rough token estimate (~4 chars per token) for the prompt plus expected output."""
+    return len(json.dumps(payload)) // 4 + ESTIMATED_OUTPUT_TOKENS
+
+class TokenBucket:
+    """Continuously refilling bucket holding at most `per_minute` units, starting at `tokens`."""
+
+    def __init__(self, per_minute: float, tokens: Optional[float] = None, updated: Optional[float] = None):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (0 if available now)."""
+        self._refill(now)
+        # A single request larger than the bucket can never fit; let it through on a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float, now: float) -> None:
+        # Negative amounts refund over-estimates; balance may go below zero on under-estimates
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+def api_key_id(api_key: str) -> str:
+    """Stable identifier for a key, so raw keys are never written to the database."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+class GeminiScheduler:
+    """
+    Token-bucket scheduler in front of generateContent calls.
+    Tracks requests/min and tokens/min per (api key, model), serves queued callers
+    in priority order, round-robins across keys and fails over down the model list
+    when the preferred model has no budget left.
+
+    Bucket levels live in the rate_limit_state table of cache.db, so every worker
+    process draws from the same budget. Priority ordering applies among the waiters
+    of one process.
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        self.db_path = db_path
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._next_key = {}  # model -> round-robin offset into its keys
+
+    def _connect(self):
+        # Autocommit mode so transactions are opened explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def _load(self, cur, api_key: str, model: str, now: float):
+        """Return (requests bucket, tokens bucket, blocked_until) for a key/model pair."""
+        rpm, tpm = get_model_rate_limit(model)
+        cur.execute(
+            "SELECT request_tokens, token_tokens, updated_at, blocked_until FROM rate_limit_state "
+            "WHERE key_id = ? AND model = ?",
+            (api_key_id(api_key), model),
+        )
+        row = cur.fetchone()
+        if not row:
+            return TokenBucket(rpm, updated=now), TokenBucket(tpm, updated=now), 0.0
+        return TokenBucket(rpm, row[0], row[2]), TokenBucket(tpm, row[1], row[2]), row[3]
+
+    def _save(self, cur, api_key: str, model: str, req_bucket: TokenBucket,
+              tok_bucket: TokenBucket, blocked_until: float) -> None:
+        cur.execute(
+            "INSERT OR REPLACE INTO rate_limit_state "
+            "(key_id, model, request_tokens, token_tokens, updated_at, blocked_until) VALUES (?, ?, ?, ?, ?, ?)",
+            (api_key_id(api_key), model, req_bucket.tokens, tok_bucket.tokens, tok_bucket.updated, blocked_until),
+        )
+
+    def _try_reserve(self, candidates: List[tuple], tokens: int):
+        """
+        Reserve budget on the first usable slot. `candidates` is [(model, [api keys])]
+        in preference order. Returns (key, model, wait).
+        """
+        min_wait = None
+        conn = self._connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            for model, api_keys in candidates:
+                start = self._next_key.get(model, 0)
+                for offset in range(len(api_keys)):
+                    index = (start + offset) % len(api_keys)
+                    api_key = api_keys[index]
+                    req_bucket, tok_bucket, blocked_until = self._load(cur, api_key, model, now)
+                    wait = max(
+                        blocked_until - now,
+                        req_bucket.wait_time(1, now),
+                        tok_bucket.wait_time(tokens, now),
+                    )
+                    if wait <= 0:
+                        req_bucket.consume(1, now)
+                        tok_bucket.consume(tokens, now)
+                        self._save(cur, api_key, model, req_bucket, tok_bucket, blocked_until)
+                        cur.execute("COMMIT")
+                        self._next_key[model] = (index + 1) % len(api_keys)
+                        return api_key, model, 0.0
+                    min_wait = wait if min_wait is None else min(min_wait, wait)
+            cur.execute("ROLLBACK")
+        finally:
+            conn.close()
+        return None, None, min_wait
+
+    def _update(self, api_key: str, model: str, consume_tokens: float = 0.0,
+                blocked_until: Optional[float] = None) -> None:
+        conn = self._connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            req_bucket, tok_bucket, current_block = self._load(cur, api_key, model, now)
+            req_bucket.consume(0, now)
+            tok_bucket.consume(consume_tokens, now)
+            self._save(cur, api_key, model, req_bucket, tok_bucket,
+                       current_block if blocked_until is None else max(current_block, blocked_until))
+            cur.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def acquire(self, candidates: List[tuple], tokens: int,
+                priority: int = PRIORITY_INTERACTIVE, max_wait: Optional[float] = None):
+        """Block until a key/model pair has budget; returns (api_key, model)."""
+        candidates = [(model, keys) for model, keys in candidates if keys]
+        if not candidates:
+            raise QuotaExhausted("No API keys or models configured")
+        if max_wait is None:
+            max_wait = SCHEDULER_MAX_WAIT_SECONDS.get(priority, SCHEDULER_MAX_WAIT_SECONDS[PRIORITY_BATCH])
+        models = [model for model, _ in candidates]
+        entry = (priority, next(self._seq))
+        deadline = time.monotonic() + max_wait
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    wait = None
+                    # Only the head of the queue may take budget, so interactive calls jump batch ones
+                    if self._waiting[0] == entry:
+                        api_key, model, wait = self._try_reserve(candidates, tokens)
+                        if api_key:
+                            return api_key, model
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise QuotaExhausted(f"Gemini quota exhausted for models {models}")
+                    self._cond.wait(min(wait, remaining) if wait else remaining)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def record_usage(self, api_key: str, model: str, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """Reconcile the reservation with the token count reported by the API."""
+        if actual_tokens is None:
+            return
+        self._update(api_key, model, consume_tokens=actual_tokens - estimated_tokens)
+        with self._cond:
+            self._cond.notify_all()
+
+    def penalize(self, api_key: str, model: str, retry_after: float) -> None:
+        """Stop using a key/model pair for a while after the API returned 429."""
+        self._update(api_key, model, blocked_until=time.time() + retry_after)
+        with self._cond:
+            self._cond.notify_all()
+
+gemini_scheduler = GeminiScheduler()
+
+def parse_retry_after(response) -> float:
+    try:
+        return max(1.0, float(response.headers.get("Retry-After")))
+    except Exception:
+        return RATE_LIMITED_COOLDOWN_SECONDS
+
+def scheduled_generate(key_models: Dict[str, List[str]], payload: dict, priority: int = PRIORITY_INTERACTIVE):
+    """
+    Call generateContent through the scheduler, failing over across keys/models on 429.
+    `key_models` maps each API key to the models it can use, in preference order.
+    Returns (model_used, parsed_response). Raises QuotaExhausted or requests exceptions.
+    """
+    models = merge_model_rankings(key_models)
+    candidates = [(m, [k for k, ranked in key_models.items() if m in ranked]) for m in models]
+    estimated = estimate_request_tokens(payload)
+    attempts = max(1, sum(len(keys) for _, keys in candidates))
+    for attempt in range(1, attempts + 1):
+        api_key, model = gemini_scheduler.acquire(candidates, estimated, priority)
+        url = generate_content_url_for_model(model, api_key)
+        try:
+            data = post_and_parse(url, payload, api_key)
+        except requests.HTTPError as e:
+            if getattr(e.response, "status_code", None) != 429:
+                raise
+            # Cool the pair down on every 429, including the last attempt
+            gemini_scheduler.penalize(api_key, model, parse_retry_after(e.response))
+            if attempt == attempts:
+                raise QuotaExhausted(f"Gemini rate limited for models {models}") from e
+            continue
+        usage = (data.get("usageMetadata") or {}) if isinstance(data, dict) else {}
+        gemini_scheduler.record_usage(api_key, model, estimated, usage.get("totalTokenCount"))
+        return model, data
+    raise QuotaExhausted(f"Gemini quota exhausted for models {models}")
+
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=5173, debug=True)
@@ -0,0 +1,138 @@
+"""
+Peak RSS of PDF text extraction by document size.
+
+Generates text-only PDFs of increasing page counts and extracts each one in a
+fresh process, so the reported peak resident set size belongs to that run alone.
+
+Modes:
+  legacy  - the previous approach: every page's text accumulated while pdfplumber
+            keeps all page objects alive until the file is closed
+  stream  - PdfPageStream, releasing each page before parsing the next
+  prefix  - read_text_prefix, what /api/pdf-mindmap does for already-indexed documents
+
+Usage:
+  python benchmarks/pdf_memory.py
+  python benchmarks/pdf_memory.py --pages 50 200 1000 --modes legacy stream
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PAGE_COUNTS = [10, 100, 500, 1000]
+MODES = ["legacy", "stream", "prefix"]
+WORDS = (
+    "cell membrane protein energy enzyme photosynthesis respiration nucleus "
+    "mitochondria chloroplast genome mutation evolution species habitat"
+).split()
+
+def sample_line(page: int, line: int) -> str:
+    words = [WORDS[(page * 7 + line * 3 + i) % len(WORDS)] for i in range(12)]
+    return f"Page {page + 1} line {line + 1}: " + " ".join(words)
+
+def write_sample_pdf(path: str, pages: int, lines_per_page: int = 60) -> None:
+    """Write a minimal text-only PDF (Helvetica, one content stream per page)."""
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join(f"{4 + 2 * i} 0 R" for i in range(pages)), pages
+        ),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i in range(pages):
+        body = " T* ".join(f"({sample_line(i, n)}) Tj" for n in range(lines_per_page))
+        content = f"BT /F1 9 Tf 40 770 Td 12 TL {body} ET"
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>"
+        )
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\nendstream")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref_at = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(out)
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_child(mode: str, pdf_path: str) -> None:
+    """Extract one PDF in this (fresh) process and print a JSON result line."""
+    sys.path.insert(0, REPO_DIR)
+    import pdf_extraction  # noqa: E402
+
+    baseline = peak_rss_mb()
+    started = time.monotonic()
+    chars = 0
+    if mode == "legacy":
+        import pdfplumber
+        text = ""
+        with pdfplumber.open(pdf_path) as pdf:
+            for page in pdf.pages:
+                page_text = page.extract_text()
+                if page_text:
+                    text += page_text + "\n"
+        chars = len(text)
+    elif mode == "stream":
+        # Caps disabled so every size is fully extracted
+        for _, page_text in pdf_extraction.PdfPageStream(pdf_path, max_pages=0, max_seconds=0, max_memory_mb=0):
+            chars += len(page_text)
+    elif mode == "prefix":
+        chars = len(pdf_extraction.read_text_prefix(pdf_extraction.PdfPageStream(pdf_path)))
+    else:
+        raise SystemExit(f"unknown mode {mode}")
+    print(json.dumps({
+        "baseline_mb": round(baseline, 1),
+        "peak_mb": round(peak_rss_mb(), 1),
+        "seconds": round(time.monotonic() - started, 2),
+        "chars": chars,
+    }))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=DEFAULT_PAGE_COUNTS)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PDF"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"{'pages':>6} {'size MB':>8} {'mode':>7} {'peak MB':>8} {'delta MB':>9} {'secs':>7} {'chars':>10}")
+        for pages in args.pages:
+            pdf_path = os.path.join(workdir, f"sample_{pages}.pdf")
+            write_sample_pdf(pdf_path, pages)
+            size_mb = os.path.getsize(pdf_path) / (1024 * 1024)
+            for mode in args.modes:
+                proc = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", mode, pdf_path],
+                    cwd=workdir, capture_output=True, text=True,
+                )
+                if proc.returncode != 0:
+                    print(f"{pages:>6} {size_mb:>8.2f} {mode:>7} failed: {proc.stderr.strip().splitlines()[-1:]}")
+                    continue
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+                print(
+                    f"{pages:>6} {size_mb:>8.2f} {mode:>7} {result['peak_mb']:>8.1f} "
+                    f"{result['peak_mb'] - result['baseline_mb']:>9.1f} {result['seconds']:>7.2f} {result['chars']:>10}"
+                )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+PDF text extraction jobs.
+
+app.py runs these in a process pool so each extraction has a process to itself:
+the memory cap then measures one job, and parsing (pure Python) runs in parallel.
+This module only depends on the PDF libraries, so pool workers never need the
+Flask app. Job functions take and return plain picklable values.
+"""
+import os
+import re
+import sqlite3
+import time
+from collections import Counter
+from typing import Optional, List, Dict, Any
+
+# PDF Processing imports
+try:
+    import PyPDF2
+    PYPDF2_AVAILABLE = True
+except ImportError:
+    PYPDF2_AVAILABLE = False
+
+try:
+    import pdfplumber
+    PDFPLUMBER_AVAILABLE = True
+except ImportError:
+    PDFPLUMBER_AVAILABLE = False
+
+# Per-job caps for PDF extraction; hitting one stops extraction and keeps the pages read so far
+PDF_MAX_PAGES = 500
+PDF_MAX_SECONDS = 60
+# Memory cap is on RSS growth of the worker process since the job started
+PDF_MAX_MEMORY_MB = 512
+# Topic analysis only looks at the start of a document, so stop extracting once we have this much
+ANALYSIS_TEXT_LIMIT = 10000
+# Limits on what is kept per document so stored statistics stay small
+STATS_MAX_TERMS = 300
+STATS_TERMS_PER_PAGE = 15
+STATS_PAGES_PER_TERM = 10
+STATS_MAX_SENTENCES = 400
+
+def current_rss_mb() -> Optional[float]:
+    """Resident set size of this process in MB (Linux only; None elsewhere)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class PdfPageStream:
+    """
+    Iterate a PDF as (page_number, text) one page at a time, releasing each page's
+    parsed objects before moving on. Stops early when the page, time or memory cap is
+    hit; `truncated` then holds the reason and the pages already yielded stand as a
+    partial result. The memory cap applies to RSS growth over the level recorded when
+    iteration starts; it is per job because pool workers run one job at a time.
+    """
+
+    def __init__(self, file_path: str, max_pages: int = PDF_MAX_PAGES,
+                 max_seconds: float = PDF_MAX_SECONDS, max_memory_mb: float = PDF_MAX_MEMORY_MB):
+        self.file_path = file_path
+        self.max_pages = max_pages
+        self.max_seconds = max_seconds
+        self.max_memory_mb = max_memory_mb
+        self.pages_read = 0
+        self.truncated = None
+        self._rss_baseline = None
+
+    def _limit_reached(self, started: float) -> Optional[str]:
+        if self.max_pages and self.pages_read >= self.max_pages:
+            return "page_limit"
+        if self.max_seconds and time.monotonic() - started > self.max_seconds:
+            return "time_limit"
+        rss = current_rss_mb()
+        if (self.max_memory_mb and rss is not None and self._rss_baseline is not None
+                and rss - self._rss_baseline > self.max_memory_mb):
+            return "memory_limit"
+        return None
+
+    def _iter_pdfplumber(self, started: float):
+        with pdfplumber.open(self.file_path) as pdf:
+            for number, page in enumerate(pdf.pages, start=1):
+                self.truncated = self._limit_reached(started)
+                if self.truncated:
+                    return
+                try:
+                    page_text = page.extract_text()
+                finally:
+                    # Drop cached chars/layout so memory stays bounded by one page
+                    if hasattr(page, "close"):
+                        page.close()
+                    else:
+                        page.flush_cache()
+                self.pages_read += 1
+                if page_text and page_text.strip():
+                    yield number, page_text
+
+    def _iter_pypdf2(self, started: float):
+        with open(self.file_path, 'rb') as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            for number, page in enumerate(pdf_reader.pages, start=1):
+                self.truncated = self._limit_reached(started)
+                if self.truncated:
+                    return
+                page_text = page.extract_text() or ""
+                self.pages_read += 1
+                yield number, page_text
+
+    def __iter__(self):
+        started = time.monotonic()
+        self._rss_baseline = current_rss_mb()
+        # Try pdfplumber first (better for complex PDFs)
+        if PDFPLUMBER_AVAILABLE:
+            yielded_text = False
+            try:
+                for number, page_text in self._iter_pdfplumber(started):
+                    yielded_text = True
+                    yield number, page_text
+                if yielded_text or self.truncated:
+                    return
+            except Exception as e:
+                print(f"pdfplumber extraction failed: {e}")
+                if yielded_text:
+                    # Can't restart mid-document without duplicating pages; keep the partial result
+                    self.truncated = "error"
+                    return
+            self.pages_read = 0
+
+        # Fallback to PyPDF2
+        if PYPDF2_AVAILABLE:
+            try:
+                yield from self._iter_pypdf2(started)
+                return
+            except Exception as e:
+                print(f"PyPDF2 extraction failed: {e}")
+                if self.pages_read:
+                    self.truncated = "error"
+                    return
+
+        raise Exception("Could not extract text from PDF. Please ensure pdfplumber or PyPDF2 is installed.")
+
+def tee_text_prefix(pages, prefix: List[str], limit: int = ANALYSIS_TEXT_LIMIT):
+    """Pass pages through unchanged while copying the first `limit` characters of text into prefix."""
+    size = 0
+    for number, text in pages:
+        if size < limit:
+            prefix.append(text[:limit - size])
+            size += len(prefix[-1]) + 1
+        yield number, text
+
+def read_text_prefix(pages, limit: int = ANALYSIS_TEXT_LIMIT) -> str:
+    """Consume pages only until `limit` characters are collected; later pages are never parsed."""
+    parts = []
+    size = 0
+    for _, text in pages:
+        parts.append(text)
+        size += len(text) + 1
+        if size >= limit:
+            break
+    return "\n".join(parts)[:limit].strip()
+
+def _job_result(stream: PdfPageStream, text: str) -> Dict[str, Any]:
+    return {"text": text, "truncated": stream.truncated, "pages_read": stream.pages_read}
+
+def read_pdf_prefix(file_path: str) -> Dict[str, Any]:
+    """Job: the analysis text prefix of a PDF, parsing only as many pages as needed."""
+    stream = PdfPageStream(file_path)
+    return _job_result(stream, read_text_prefix(stream))
+
+def stage_pdf_pages(file_path: str, db_path: str, build_id: str, batch_pages: int) -> Dict[str, Any]:
+    """
+    Job: extract every page into document_pages_staging under `build_id`, in small
+    committed batches so only a few pages of text are held and the write lock isn't
+    kept while parsing. Returns the analysis text prefix and completeness; the caller
+    swaps the staged rows in.
+    """
+    stream = PdfPageStream(file_path)
+    prefix = []
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        cur = conn.cursor()
+        batch = []
+        for number, text in tee_text_prefix(stream, prefix):
+            if text and text.strip():
+                batch.append((build_id, number, text))
+            if len(batch) >= batch_pages:
+                cur.executemany("INSERT INTO document_pages_staging (build_id, page, content) VALUES (?, ?, ?)", batch)
+                conn.commit()
+                batch = []
+        if batch:
+            cur.executemany("INSERT INTO document_pages_staging (build_id, page, content) VALUES (?, ?, ?)", batch)
+            conn.commit()
+    finally:
+        conn.close()
+    return _job_result(stream, "\n".join(prefix).strip())
+
+def compute_document_stats(pages, stop_words: set) -> Dict[str, Any]:
+    """
+    Reduce a page stream to term counts, the pages each term is prominent on and a
+    sample of short sentences with their page. Pages are discarded as they are read.
+    """
+    terms = Counter()
+    term_pages = {}
+    sentences = []
+    for number, text in pages:
+        page_terms = Counter(
+            w for w in re.findall(r"[a-z][a-z0-9\-]{2,}", text.lower()) if w not in stop_words
+        )
+        terms.update(page_terms)
+        for term, _ in page_terms.most_common(STATS_TERMS_PER_PAGE):
+            seen = term_pages.setdefault(term, [])
+            if len(seen) < STATS_PAGES_PER_TERM:
+                seen.append(number)
+        if len(sentences) < STATS_MAX_SENTENCES:
+            for sentence in re.split(r"(?<=[.!?])\s+", " ".join(text.split())):
+                if 40 <= len(sentence) <= 200:
+                    sentences.append([sentence, number])
+                    if len(sentences) >= STATS_MAX_SENTENCES:
+                        break
+    top_terms = dict(terms.most_common(STATS_MAX_TERMS))
+    return {
+        "terms": top_terms,
+        "total_terms": sum(terms.values()),
+        "term_pages": {t: term_pages.get(t, []) for t in top_terms},
+        "sentences": sentences,
+    }
+
+def document_stats(file_path: str, stop_words: set) -> Dict[str, Any]:
+    """Job: extract one PDF and reduce it to term statistics for multi-document mind maps."""
+    stream = PdfPageStream(file_path)
+    stats = compute_document_stats(stream, stop_words)
+    stats["partial_reason"] = stream.truncated
+    return stats